@@ -1,14 +1,198 @@
 # -*- coding: utf-8 -*-
-from base64 import b64decode
+from datetime import timedelta
+from functools import lru_cache
 import logging
+import time
 
-from airflow.exceptions import AirflowException
+from airflow.exceptions import AirflowException, AirflowSensorTimeout
 from airflow.hooks.base_hook import BaseHook
-from airflow.hooks.http_hook import HttpHook
+from airflow.models import TaskReschedule
 from airflow.operators.sensors import BaseSensorOperator
 from airflow.utils.decorators import apply_defaults
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-logging.basicConfig(format='%(asctime)s - %(levelname)s:%(message)s', level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+# NOTE: a single session is shared by the sensor and the storage operators so
+#       repeated pokes reuse keep-alive connections instead of doing a new
+#       TCP + TLS handshake each time (as a fresh HttpHook would)
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+)
+_SESSION.mount('https://', _ADAPTER)
+_SESSION.mount('http://', _ADAPTER)
+_TIMEOUT = (5, 30)
+_BACKOFF_FACTOR = 1.3
+_BULK_LIMIT = 100
+_RUNNING = frozenset({"QUEUED", "RUNNING"})
+_FAILED = frozenset({"ABORTED", "FAILED"})
+
+
+@lru_cache(maxsize=8)
+def _get_connection(cavatica_conn_id):
+    """Fetches an Airflow connection from the metadata DB once per connection id"""
+    return BaseHook.get_connection(cavatica_conn_id)
+
+
+@lru_cache(maxsize=8)
+def _connection(cavatica_conn_id):
+    """Resolves the base URL, auth, and extra headers of an Airflow connection the same way HttpHook does"""
+    conn = _get_connection(cavatica_conn_id)
+    if conn.host and '://' in conn.host:
+        base_url = conn.host
+    else:
+        schema = conn.schema if conn.schema else 'http'
+        base_url = f'{schema}://{conn.host}'
+    if conn.port:
+        base_url = f'{base_url}:{conn.port}'
+
+    auth = (conn.login, conn.password) if conn.login else None
+
+    extra_headers = {}
+    if conn.extra:
+        try:
+            extra_headers = dict(conn.extra_dejson)
+        except TypeError:
+            log.warning(f'Connection to {conn.host} has invalid extra field.')
+
+    return base_url.rstrip('/'), auth, extra_headers
+
+
+def _next_poke_interval(poke_interval, poke_count, max_wait):
+    """Grows poke_interval exponentially with each poke, capped at max_wait seconds"""
+    return min(poke_interval * _BACKOFF_FACTOR ** poke_count, max_wait)
+
+
+@lru_cache(maxsize=8)
+def _cached_headers(cavatica_conn_id):
+    """Builds the Cavatica HTTP headers once per Airflow connection"""
+    return {
+        "Content-Type": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "X-SBG-Auth-Token": _get_connection(cavatica_conn_id).get_password()
+    }
+
+
+def _extract(response, *keys):
+    """Parses a Cavatica API response with orjson and walks down the given keys"""
+    value = orjson.loads(response.content)
+    for key in keys:
+        value = value[key]
+    return value
+
+
+def _parse_status(response_json):
+    """Reads the upper-cased status of a Cavatica task, import, or export job"""
+    try:
+        if 'status' in response_json.keys():
+            return response_json["status"].upper()
+        elif 'state' in response_json.keys():
+            return response_json["state"].upper()
+        else:
+            msg = 'Only responses with "state" or "status" keys are supported'
+            raise NotImplementedError(msg)
+    except Exception as err:
+        msg = f'Unable to parse Cavatica API response: {err}'
+        log.error(msg)
+        raise AirflowException(msg)
+
+
+def _is_completed(cavatica_task_id, status):
+    """Returns True if COMPLETED, False if still running, and raises otherwise"""
+    if status in _RUNNING:
+        log.info(f'{cavatica_task_id} is still running...')
+        return False
+    elif status == "COMPLETED":
+        log.info(f'{cavatica_task_id} finished successfully!')
+        return True
+    elif status == "PENDING":
+        msg = f'{cavatica_task_id} is pending and needs to be started!'
+        log.error(msg)
+        raise AirflowException(msg)
+    elif status in _FAILED:
+        msg = f'{cavatica_task_id} did not finish!'
+        log.error(msg)
+        raise AirflowException(msg)
+    else:
+        msg = f'{cavatica_task_id} has unhandled job state "{status}", this DAG run will be failed'
+        raise AirflowException(msg)
+
+
+def _cavatica_request(method, cavatica_conn_id, endpoint, headers, **kwargs):
+    """Sends a request to a Cavatica API endpoint using the shared session.
+
+    Like HttpHook, the connection's extra field is sent as headers, with the
+    caller's headers taking precedence, and its login is used for basic auth.
+    """
+    base_url, auth, extra_headers = _connection(cavatica_conn_id)
+    url = f"{base_url}/{endpoint.lstrip('/')}"
+    return _SESSION.request(
+        method,
+        url,
+        headers={**extra_headers, **(headers or {})},
+        auth=auth,
+        timeout=_TIMEOUT,
+        **kwargs
+    )
+
+
+def _cavatica_get(cavatica_conn_id, endpoint, headers):
+    """GET a Cavatica API endpoint using the shared session"""
+    return _cavatica_request('GET', cavatica_conn_id, endpoint, headers)
+
+
+def _cavatica_post(cavatica_conn_id, endpoint, headers, json):
+    """POST a JSON payload to a Cavatica API endpoint using the shared session"""
+    return _cavatica_request('POST', cavatica_conn_id, endpoint, headers, json=json)
+
+
+def _get_details(cavatica_conn_id, endpoint, cavatica_task_id, headers):
+    """GET the details of a Cavatica job and parse the JSON response"""
+    response = _cavatica_get(cavatica_conn_id, f'{endpoint}{cavatica_task_id}', headers)
+    response.raise_for_status()
+
+    try:
+        return _extract(response)
+    except Exception as err:
+        msg = f'Unable to parse Cavatica API response: {err}'
+        log.error(msg)
+        raise AirflowException(msg)
+
+
+def _wait_for_completion(cavatica_conn_id,
+                         endpoint,
+                         cavatica_task_id,
+                         headers,
+                         poke_interval=5,
+                         timeout=3600,
+                         max_wait=timedelta(minutes=5)
+                         ):
+    """Polls a Cavatica job like CavaticaTaskSensor in poke mode.
+
+    Used by the storage operators, which wait for their own job from within
+    execute(). Returns the details of the job once it is COMPLETED.
+    """
+    endpoint = endpoint if endpoint.endswith('/') else f'{endpoint}/'
+    started_at = time.monotonic()
+    poke_count = 0
+    while True:
+        response_json = _get_details(cavatica_conn_id, endpoint, cavatica_task_id, headers)
+        if _is_completed(cavatica_task_id, _parse_status(response_json)):
+            return response_json
+
+        if time.monotonic() - started_at > timeout:
+            msg = f'{cavatica_task_id} did not finish within {timeout} seconds'
+            log.error(msg)
+            raise AirflowSensorTimeout(msg)
+
+        time.sleep(_next_poke_interval(poke_interval, poke_count, max_wait.total_seconds()))
+        poke_count += 1
 
 
 class CavaticaTaskSensor(BaseSensorOperator):
@@ -39,6 +223,27 @@ class CavaticaTaskSensor(BaseSensorOperator):
     endpoint: optional, specific GET endpoint the accepts a cavatica_task_id
         type:       str
         example:    /tasks/ (default)
+    mode: optional, how the sensor waits between pokes
+        type:       str
+        example:    reschedule (default) or poke
+    poke_interval: optional, seconds to wait before the second poke
+        type:       int
+        example:    5 (default)
+    exponential_backoff: optional, grow the wait between pokes by a factor of 1.3
+        type:       bool
+        example:    True (default)
+    max_wait: optional, longest wait between pokes when using exponential_backoff
+        type:       timedelta
+        example:    timedelta(minutes=5) (default)
+
+    NOTE: Cavatica tasks usually run for minutes to hours, so this sensor
+    defaults to mode='reschedule'. The worker slot is released between pokes and
+    the task is rescheduled after poke_interval, at the cost of a scheduler
+    round-trip per poke. Use mode='poke' for short jobs with a small
+    poke_interval, or when the sensor is executed from within another
+    operator's execute() method. Deferrable sensors need the triggerer from
+    Airflow 2.2+, which these plugins do not target, so reschedule mode is how
+    this sensor avoids holding a worker slot while Cavatica does the work.
 
 
     returns True or False
@@ -53,28 +258,57 @@ class CavaticaTaskSensor(BaseSensorOperator):
                  cavatica_conn_id,
                  cavatica_headers={},
                  endpoint='/tasks/',
+                 mode='reschedule',
+                 poke_interval=5,
+                 exponential_backoff=True,
+                 max_wait=timedelta(minutes=5),
                  *args,
                  **kwargs
                  ):
-        super(CavaticaTaskSensor, self).__init__(*args, **kwargs)
+        super(CavaticaTaskSensor, self).__init__(
+            *args,
+            poke_interval=poke_interval,
+            mode=mode,
+            **kwargs
+        )
         self.cavatica_task_id = cavatica_task_id
         self.cavatica_conn_id = cavatica_conn_id
         self.cavatica_headers = cavatica_headers
         self.endpoint = endpoint if endpoint.endswith('/') else f'{endpoint}/'
+        self.exponential_backoff = exponential_backoff
+        self.max_wait = max_wait
+        self._initial_poke_interval = poke_interval
+        self._poke_count = 0
 
     @staticmethod
     def _build_headers(cavatica_conn_id):
         """Generates HTTP headers based on the Cavatica Airflow connection"""
         try:
-            return {
-                "Content-Type": "application/json",
-                "X-SBG-Auth-Token": BaseHook.get_connection(cavatica_conn_id).get_password()
-            }
+            # copy so callers can't modify the cached headers
+            return dict(_cached_headers(cavatica_conn_id))
         except Exception as err:
             msg = f'Unable to generate headers using the cavatica_conn_id: {err}'
-            logging.error(msg)
+            log.error(msg)
             raise AirflowException(msg)
 
+    def _backoff(self, context):
+        """Sets the poke_interval used by BaseSensorOperator before the next poke"""
+        if not self.exponential_backoff:
+            return
+
+        if self.reschedule:
+            # each reschedule runs a new sensor instance, so count the reschedules
+            poke_count = len(TaskReschedule.find_for_task_instance(context['ti']))
+        else:
+            poke_count = self._poke_count
+            self._poke_count += 1
+
+        self.poke_interval = _next_poke_interval(
+            self._initial_poke_interval,
+            poke_count,
+            self.max_wait.total_seconds()
+        )
+
     def poke(self, context):
         """Check the status using the GET method.
 
@@ -87,38 +321,124 @@ class CavaticaTaskSensor(BaseSensorOperator):
         if not self.cavatica_headers:
             self.cavatica_headers = self._build_headers(self.cavatica_conn_id)
 
-        api = HttpHook(method='GET', http_conn_id=self.cavatica_conn_id)
-        response = api.run(endpoint=f'{self.endpoint}{self.cavatica_task_id}', headers=self.cavatica_headers)
-        response.raise_for_status()
+        response_json = _get_details(
+            self.cavatica_conn_id,
+            self.endpoint,
+            self.cavatica_task_id,
+            self.cavatica_headers
+        )
+        completed = _is_completed(self.cavatica_task_id, _parse_status(response_json))
+        if not completed:
+            self._backoff(context)
+        return completed
 
-        try:
-            response_json = response.json()
-            if 'status' in response_json.keys():
-                status = response_json["status"].upper()
-            elif 'state' in response_json.keys():
-                status = response_json["state"].upper()
-            else:
-                msg = 'Only responses with "state" or "status" keys are supported'
-                raise NotImplementedError(msg)
-        except Exception as err:
-            msg = f'Unable to parse Cavatica API response: {err}'
-            logging.error(msg)
-            raise AirflowException(msg)
 
-        if status in ["QUEUED", "RUNNING"]:
-            logging.info(f'{self.cavatica_task_id} is still running...')
-            return False
-        elif status == "COMPLETED":
-            logging.info(f'{self.cavatica_task_id} finished successfully!')
-            return True
-        elif status == "PENDING":
-            msg = f'{self.cavatica_task_id} is pending and needs to be started!'
-            logging.error(msg)
-            raise AirflowException(msg)
-        elif status in ["ABORTED", "FAILED"]:
-            msg = f'{self.cavatica_task_id} did not finish!'
-            logging.error(msg)
-            raise AirflowException(msg)
-        else:
-            msg = f'{self.cavatica_task_id} has unhandled job state "{status}", this DAG run will be failed'
+class CavaticaBulkTaskSensor(CavaticaTaskSensor):
+    """Uses the Cavatica bulk API to monitor several tasks with one request per poke.
+
+    This sensor behaves like CavaticaTaskSensor, but returns True only once every
+    task in cavatica_task_ids is 'COMPLETED'. Any task that fails raises an
+    AirflowException right away. Use it instead of one CavaticaTaskSensor per task
+    when a DAG starts many Cavatica jobs in parallel.
+
+    The bulk endpoints accept at most 100 IDs per request, so longer lists are
+    split into several requests.
+
+    cavatica_task_ids: the IDs assigned to the Cavatica tasks. each ID is eligible for
+        Jinja2 templating, but the value must stay a list: a single template such as
+        "{{ ti.xcom_pull(...) }}" renders to a string and is rejected
+        type:       list
+        example:    ["4c8f18a1-3596-49bf-a2a2-b5e598666435", ...]
+    cavatica_conn_id: name of the Airflow Connection that points to Cavatica.
+        type:       str
+        example:    cavatica
+    cavatica_headers: optional, HTTP request headers for the Cavatica API
+        type:       dict
+        example:    {"Content-Type": "application/json", "X-SBG-Auth-Token": <token>}
+    endpoint: optional, bulk POST endpoint that returns the details of several jobs
+        type:       str
+        example:    /bulk/tasks/get (default), /bulk/storage/imports/get, /bulk/storage/exports/get
+    ids_field: optional, name of the request body field that holds the IDs
+        type:       str
+        example:    task_ids (default), import_ids, export_ids
+
+    Other keyword arguments are the same as for CavaticaTaskSensor.
+
+
+    returns True or False
+    """
+
+    template_fields = ['cavatica_task_ids']
+
+    @apply_defaults
+    def __init__(self,
+                 cavatica_task_ids,
+                 cavatica_conn_id,
+                 cavatica_headers={},
+                 endpoint='/bulk/tasks/get',
+                 ids_field='task_ids',
+                 *args,
+                 **kwargs
+                 ):
+        super(CavaticaBulkTaskSensor, self).__init__(
+            *args,
+            cavatica_task_id=None,
+            cavatica_conn_id=cavatica_conn_id,
+            cavatica_headers=cavatica_headers,
+            **kwargs
+        )
+        self.cavatica_task_ids = cavatica_task_ids
+        self.endpoint = endpoint
+        self.ids_field = ids_field
+
+    def poke(self, context):
+        """Check the status of every task using the bulk POST method."""
+
+        if not self.cavatica_headers:
+            self.cavatica_headers = self._build_headers(self.cavatica_conn_id)
+
+        if not isinstance(self.cavatica_task_ids, (list, tuple)):
+            msg = (f'cavatica_task_ids must be a list of IDs, got {type(self.cavatica_task_ids).__name__}: '
+                   f'{self.cavatica_task_ids!r}')
+            log.error(msg)
             raise AirflowException(msg)
+
+        task_ids = list(self.cavatica_task_ids)
+        completed = True
+        for start in range(0, len(task_ids), _BULK_LIMIT):
+            chunk = task_ids[start:start + _BULK_LIMIT]
+            response = _cavatica_post(
+                self.cavatica_conn_id,
+                self.endpoint,
+                self.cavatica_headers,
+                {self.ids_field: chunk}
+            )
+            response.raise_for_status()
+
+            try:
+                items = _extract(response, "items")
+            except Exception as err:
+                msg = f'Unable to parse Cavatica API response: {err}'
+                log.error(msg)
+                raise AirflowException(msg)
+
+            # NOTE: match items to IDs instead of trusting the response order, so
+            #       a task missing from the response can't be counted as done
+            resources = {}
+            for item in items:
+                if 'resource' not in item:
+                    msg = f'Unable to get details of a task in {chunk}: {item.get("error")}'
+                    log.error(msg)
+                    raise AirflowException(msg)
+                resources[item["resource"].get("id")] = item["resource"]
+
+            for cavatica_task_id in chunk:
+                if cavatica_task_id not in resources:
+                    msg = f'Cavatica API response has no details for {cavatica_task_id}'
+                    log.error(msg)
+                    raise AirflowException(msg)
+                completed = _is_completed(cavatica_task_id, _parse_status(resources[cavatica_task_id])) and completed
+
+        if not completed:
+            self._backoff(context)
+        return completed
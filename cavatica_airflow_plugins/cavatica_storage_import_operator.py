@@ -1,17 +1,10 @@
 # -*- coding: utf-8 -*-
-from base64 import b64decode
-import logging
 import time
 
-from airflow.exceptions import AirflowException
-from airflow.hooks.base_hook import BaseHook
-from airflow.hooks.http_hook import HttpHook
 from airflow.models.baseoperator import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
-from cavatica_airflow_plugins.cavatica_sensor import CavaticaTaskSensor
-
-logging.basicConfig(format='%(asctime)s - %(levelname)s:%(message)s', level=logging.DEBUG)
+from cavatica_airflow_plugins.cavatica_sensor import CavaticaTaskSensor, _cavatica_post, _extract, _wait_for_completion
 
 
 class CavaticaStorageImportOperator(BaseOperator):
@@ -20,10 +13,10 @@ class CavaticaStorageImportOperator(BaseOperator):
     https://docs.cavatica.org/docs/start-an-export-job-v2
     https://docs.cavatica.org/docs/get-details-of-an-export-job-v2
 
-    The CavaticaTaskSensor is imported here to monitor the export job. This Operator 
-    requires HTTP headers and passes them down to the CavaticaTaskSensor. This is
-    to ensure the sensor has permissions to monitor the job in case two different
-    Airflow connections are used.
+    The import job is monitored from within this Operator the same way the
+    CavaticaTaskSensor does in poke mode, using the same HTTP headers that started
+    the job. This is to ensure it has permissions to monitor the job in case two
+    different Airflow connections are used.
 
     This Operator will return True when the import job has completed successfully,
     or fail the DAG if the export job fails.
@@ -31,7 +24,8 @@ class CavaticaStorageImportOperator(BaseOperator):
     cavatica_conn_id: name of the Airflow Connection that points to Cavatica.
         type:       str
         example:    cavatica
-    cavatica_headers: HTTP request headers for the Cavatica API
+    cavatica_headers: HTTP request headers for the Cavatica API. If empty, they are
+        built from the cavatica_conn_id like in CavaticaTaskSensor
         type:       dict
         example:    {"Content-Type": "application/json", "X-SBG-Auth-Token": <token>}
     destination_parent_uri: Cavatica parent folder ID where the file will be imported to
@@ -46,6 +40,13 @@ class CavaticaStorageImportOperator(BaseOperator):
     optional_fields: optional, other key-value pairs the Cavatica endpoint accepts
         type:       dict
         example:    {"overwrite": True, "sse_algorithm": "AES256"}
+    poke_interval: optional, seconds to wait before checking the job again. Grows
+        by a factor of 1.3 up to 5 minutes, like CavaticaTaskSensor
+        type:       int
+        example:    5 (default)
+    timeout: optional, seconds to wait for the job before failing
+        type:       int
+        example:    3600 (default)
 
 
     returns the Cavatica URI of the import file
@@ -63,6 +64,8 @@ class CavaticaStorageImportOperator(BaseOperator):
                  optional_fields={},
                  endpoint='/storage/imports',
                  sleep=3,
+                 poke_interval=5,
+                 timeout=3600,
                  *args,
                  **kwargs
                  ):
@@ -73,11 +76,16 @@ class CavaticaStorageImportOperator(BaseOperator):
         self.source_volume = source_volume
         self.source_location = source_location
         self.optional_fields = optional_fields
-        self.endpoint = endpoint
+        self.endpoint = endpoint.rstrip('/')
         self.sleep = sleep
+        self.poke_interval = poke_interval
+        self.timeout = timeout
 
     def execute(self, context):
-        """Start import job and wait for COMPLETED from CavaticaTaskSensor."""
+        """Start import job and wait until Cavatica reports it COMPLETED."""
+
+        if not self.cavatica_headers:
+            self.cavatica_headers = CavaticaTaskSensor._build_headers(self.cavatica_conn_id)
 
         payload = {
             "source": {
@@ -89,32 +97,23 @@ class CavaticaStorageImportOperator(BaseOperator):
             }
         }
 
-        if self.optional_fields:
-            for key in self.optional_fields.keys():
-                payload[key] = self.optional_fields[key]
+        payload.update(self.optional_fields or {})
 
-        api = HttpHook(method='POST', http_conn_id=self.cavatica_conn_id)
-        response = api.run(endpoint=self.endpoint, json=payload, headers=self.cavatica_headers)
+        response = _cavatica_post(self.cavatica_conn_id, self.endpoint, self.cavatica_headers, payload)
         response.raise_for_status()
 
         # NOTE: the task sensor fails PENDING jobs, but storage imports might take some
         #       time to start up, so we wait here for 3 seconds
         time.sleep(self.sleep)
-        import_task_id = response.json()["id"]
-
-        wait_for_import_success = CavaticaTaskSensor(
-            task_id='wait_for_import_success',
-            cavatica_task_id=import_task_id,
-            cavatica_conn_id=self.cavatica_conn_id,
-            cavatica_headers=self.cavatica_headers,
-            endpoint=f'{self.endpoint}/',
-            poke=10,
-            timeout=3600
+        import_task_id = _extract(response, "id")
+
+        import_details = _wait_for_completion(
+            self.cavatica_conn_id,
+            self.endpoint,
+            import_task_id,
+            self.cavatica_headers,
+            poke_interval=self.poke_interval,
+            timeout=self.timeout
         )
-        wait_for_import_success.execute(context)
-
-        api = HttpHook(method='GET', http_conn_id=self.cavatica_conn_id)
-        response = api.run(endpoint=f'{self.endpoint}/{import_task_id}', headers=self.cavatica_headers)
-        response.raise_for_status()
 
-        return response.json()["result"]["id"]
+        return import_details["result"]["id"]
@@ -6,8 +6,9 @@ from setuptools import setup, find_packages
 
 def parse_requirements():
     """ load requirements from a pip requirements file """
-    lineiter = (line.strip() for line in open('requirements.txt'))
-    return [line for line in lineiter if line and not line.startswith("#")]
+    with open('requirements.txt') as requirements_file:
+        lineiter = (line.strip() for line in requirements_file)
+        return [line for line in lineiter if line and not line.startswith("#")]
 
 
 with open('README.rst') as readme_file: